@@ -339,15 +339,16 @@ def get_rawimage_path(rawimage_filename="sd_card.img"):
         return None
 
 
-def run(cmd, shell=False, timeout=1):
+def run(cmd, shell=False, timeout=1, cwd=None):
     """
     Spawns a new process launching cmd, connect to their input/output/error pipes, and obtain their return codes.
 
-    :param cmd: command split in the form of a list
+    :param cmd: command split in the form of a list (or a string, if shell=True)
+    :param cwd: working directory of the new process, defaults to the current one
     :returns: stdout
     """
     proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell, cwd=cwd
     )
     try:
         outs, errs = proc.communicate(timeout=timeout)
@@ -2,8 +2,12 @@
 # Licensed under the Apache License, Version 2.0
 
 import os
+import pwd
 import sys
 import errno
+import glob
+import shutil
+import tempfile
 from pathlib import Path
 
 from colcon_core.plugin_system import satisfies_version
@@ -37,6 +41,49 @@ UBOOT_SCRIPT=boot.scr
 """
 
 
+def _write_config(path, text):
+    """
+    Write the imagebuilder configuration in a single unbuffered write,
+    O_TRUNC deletes any previous content.
+
+    param path: path of the configuration file
+    param text: content of the configuration
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, text.encode())
+    finally:
+        os.close(fd)
+
+
+def _link_artifacts(artifacts):
+    """
+    Symlink artifacts into a directory instead of copying them, replacing
+    any previous file or link at the destination.
+
+    param artifacts: dict mapping destination to source file paths
+    """
+    errs = []
+    for dst, src in artifacts.items():
+        if not os.path.exists(src):
+            errs.append(src + " not found")
+            continue
+        try:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.symlink(src, dst)
+        except OSError as e:
+            errs.append(src + " -> " + dst + ": " + str(e))
+
+    if errs:
+        red(
+            "Something went wrong while linking artifacts.\n"
+            + "Review the output:\n"
+            + "\n".join(errs)
+        )
+        sys.exit(1)
+
+
 class HypervisorSubverb(AccelerationSubverbExtensionPoint):
     """
     Configure the Xen hypervisor.
@@ -123,29 +170,17 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         # create auxiliary directory for compiling all artifacts for the hypervisor
         auxdir = "/tmp/hypervisor"
-        run("mkdir " + auxdir, shell=True, timeout=1)
-
-        # copy the artifacts to auxiliary directory
-        run(
-            "cp " + firmware_dir + "/kernel/Image " + auxdir + "/Image",
-            shell=True,
-            timeout=1,
-        )
-        run("cp " + firmware_dir + "/xen " + auxdir + "/xen", shell=True, timeout=1)
-        run(
-            "cp "
-            + firmware_dir
-            + "/device_tree/system.dtb.xen "
-            + auxdir
-            + "/system.dtb",
-            shell=True,
-            timeout=1,
-        )
-        run(
-            "cp " + firmware_dir + "/initrd.cpio " + auxdir + "/initrd.cpio",
-            shell=True,
-            timeout=1,
-        )
+        os.makedirs(auxdir, exist_ok=True)
+
+        # collect the artifacts to link into the auxiliary directory
+        artifacts = {
+            auxdir + "/Image": firmware_dir + "/kernel/Image",
+            auxdir + "/xen": firmware_dir + "/xen",
+            auxdir + "/system.dtb": firmware_dir + "/device_tree/system.dtb.xen",
+        }
+        # initrd.cpio isn't referenced by the default config, carry it if present
+        if exists(firmware_dir + "/initrd.cpio"):
+            artifacts[auxdir + "/initrd.cpio"] = firmware_dir + "/initrd.cpio"
 
         # handle BOOT.BIN separately, priorizing first the symlink generated by building kernels
         bootbin_symlink_path = Path(firmware_dir + "/BOOT.BIN")
@@ -166,40 +201,27 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                 red("BOOT.BIN file " + bootbin_symlink_path + " not found.")
                 sys.exit(1)
             green("- Found device BOOT.BIN file: " + str(bootbin_symlink_path))
-            run(
-                "cp " + str(bootbin_symlink_path) + " " + auxdir + "/BOOT.BIN",
-                shell=True,
-                timeout=1,
-            )
+            artifacts[auxdir + "/BOOT.BIN"] = str(bootbin_symlink_path)
         else:
             green("- Using default BOOT.BIN.xen file.")
-            run(
-                "cp " + firmware_dir + "/bootbin/BOOT.BIN.xen " + auxdir + "/BOOT.BIN",
-                shell=True,
-                timeout=1,
-            )
+            artifacts[auxdir + "/BOOT.BIN"] = firmware_dir + "/bootbin/BOOT.BIN.xen"
+
+        # link the artifacts into the auxiliary directory, "sudo cp" below
+        # follows them and copies the targets into the boot partition
+        _link_artifacts(artifacts)
 
         # produce config
-        config = open(auxdir + "/xen.cfg", "w")
-        config.truncate(0)  # delete previous content
-        config.write(TEMPLATE_CONFIG)
-        config.close()
+        _write_config(auxdir + "/xen.cfg", TEMPLATE_CONFIG)
 
         # generate boot script
         imagebuilder_dir = firmware_dir + "/imagebuilder"
         imagebuilder_path = imagebuilder_dir + "/scripts/uboot-script-gen"
-        cmd = (
-            "cd "
-            + auxdir
-            + " && bash "
-            + imagebuilder_path
-            + ' -c xen.cfg -d . -t "load mmc 0:1"'
-        )
+        cmd = ["bash", imagebuilder_path, "-c", "xen.cfg", "-d", ".", "-t", "load mmc 0:1"]
 
         if context.args.debug:
-            gray(cmd)
+            gray(" ".join(cmd))
 
-        outs, errs = run(cmd, shell=True, timeout=5)
+        outs, errs = run(cmd, timeout=5, cwd=auxdir)
         if errs:
             red("Something went wrong.\n" + "Review the output: " + errs)
             sys.exit(1)
@@ -210,8 +232,8 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
         mount_rawimage(rawimage_path, 1)
 
         # copy all artifacts
-        cmd = "sudo cp " + auxdir + "/* " + mountpoint1 + "/"
-        outs, errs = run(cmd, shell=True, timeout=5)
+        cmd = ["sudo", "cp"] + sorted(glob.glob(auxdir + "/*")) + [mountpoint1 + "/"]
+        outs, errs = run(cmd, timeout=5)
         if errs:
             red(
                 "Something went wrong while replacing the boot script.\n"
@@ -226,7 +248,7 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         # cleanup auxdir
         if not context.args.debug:
-            run("sudo rm -r " + auxdir, shell=True, timeout=1)
+            shutil.rmtree(auxdir, ignore_errors=True)
 
     def argument_checks(self, context):
         """
@@ -234,30 +256,29 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         TODO: document arguments
         """
+        # number of VMs, ramdisks and rootfs requested (each arg may be None)
+        num_domus = len(context.args.domU_args) if context.args.domU_args else 0
+        num_dom0less = (
+            len(context.args.dom0less_args) if context.args.dom0less_args else 0
+        )
+        num_ramdisks = len(context.args.ramdisk_args) if context.args.ramdisk_args else 0
+        num_rootfs = len(context.args.rootfs_args) if context.args.rootfs_args else 0
+
         # ensure ramdisks don't overrun domUs + dom0less
         # NOTE that dom0 doesn't count
         if (
-            context.args.ramdisk_args
-            and context.args.domU_args
-            and context.args.dom0less_args
-            and (
-                len(context.args.domU_args) + len(context.args.dom0less_args)
-                < len(context.args.ramdisk_args)
-            )
-            or context.args.ramdisk_args
-            and context.args.dom0less_args
-            and (len(context.args.dom0less_args) < len(context.args.ramdisk_args))
-        ):
+            num_ramdisks
+            and num_domus
+            and num_dom0less
+            and num_domus + num_dom0less < num_ramdisks
+        ) or (num_ramdisks and num_dom0less and num_dom0less < num_ramdisks):
             red(
                 "- More ramdisks provided than VMs. Note that dom0's ramdisk should NOT be indicated (ramdisks <= domUs + dom0less)."
             )
             sys.exit(1)
 
         # ensure rootfs don't overrun domUs + dom0less + dom0 (+1)
-        if context.args.rootfs_args and (
-            len(context.args.domU_args) + len(context.args.dom0less_args) + 1
-            < len(context.args.rootfs_args)
-        ):
+        if num_rootfs > num_domus + num_dom0less + 1:
             red(
                 "- More rootfs provided than VMs, including dom0's (rootfs <= domUs + dom0less + 1)."
             )
@@ -265,12 +286,9 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         # ensure rootfs and ramdisks don't overrun domUs + dom0less + dom0 (+1)
         if (
-            context.args.ramdisk_args
-            and context.args.rootfs_args
-            and (
-                len(context.args.domU_args) + len(context.args.dom0less_args) + 1
-                < len(context.args.ramdisk_args) + len(context.args.rootfs_args)
-            )
+            num_ramdisks
+            and num_rootfs
+            and num_domus + num_dom0less + 1 < num_ramdisks + num_rootfs
         ):
             red(
                 "- More rootfs and ramdisks provided than VMs, including dom0's (rootfs + ramdisks <= domUs + dom0less + 1)."
@@ -279,12 +297,9 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         # inform if the domUs + dom0less + dom0 (+1) count is greater than rootfs + ramdisks count
         if (
-            context.args.ramdisk_args
-            and context.args.rootfs_args
-            and (
-                len(context.args.domU_args) + len(context.args.dom0less_args) + 1
-                > len(context.args.ramdisk_args) + len(context.args.rootfs_args)
-            )
+            num_ramdisks
+            and num_rootfs
+            and num_domus + num_dom0less + 1 > num_ramdisks + num_rootfs
         ):
             yellow("- More VMs than ramdisks and rootfs provided, will use defaults.")
 
@@ -311,16 +326,14 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
         """
         Fixup Xen FS
         """
-        firmware_dir = get_firmware_dir()
-
         # mount sd_card image
         rawimage_path = get_rawimage_path("sd_card.img")
         mount_rawimage(rawimage_path, partition)
 
         mountpoint_partition = mountpointn + str(partition)
         # create Xen missing dir
-        cmd = "sudo mkdir -p " + mountpoint_partition + "/var/lib/xen"
-        outs, errs = run(cmd, shell=True, timeout=5)
+        cmd = ["sudo", "mkdir", "-p", mountpoint_partition + "/var/lib/xen"]
+        outs, errs = run(cmd, timeout=5)
         if errs:
             red(
                 "Something went wrong while creating Xen /var/lib/xen directory in rootfs.\n"
@@ -331,13 +344,33 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
         green("- Successfully created Xen /var/lib/xen directory in rootfs.")
 
         if not self.get_board() == "kv260":
-            # setup /etc/inittab for Xen
-            cmd = (
-                "sudo sed -i 's-PS0:12345:respawn:/bin/start_getty 115200 ttyPS0 vt102-X0:12345:respawn:/sbin/getty 115200 hvc0-g' "
-                + mountpoint_partition
-                + "/etc/inittab"
-            )
-            outs, errs = run(cmd, shell=True, timeout=5)
+            # setup /etc/inittab for Xen, only writing it back if it changed
+            inittab_path = mountpoint_partition + "/etc/inittab"
+            errs = None
+            try:
+                inittab = Path(inittab_path).read_bytes()
+                inittab_xen = inittab.replace(
+                    b"PS0:12345:respawn:/bin/start_getty 115200 ttyPS0 vt102",
+                    b"X0:12345:respawn:/sbin/getty 115200 hvc0",
+                )
+                if inittab_xen != inittab:
+                    if os.geteuid() == 0:
+                        inittab_tmp = inittab_path + ".tmp"
+                        Path(inittab_tmp).write_bytes(inittab_xen)
+                        shutil.copymode(inittab_path, inittab_tmp)
+                        os.replace(inittab_tmp, inittab_path)
+                    else:
+                        # rootfs is owned by root, "sudo cp" keeps the
+                        # owner and mode of the existing inittab
+                        with tempfile.NamedTemporaryFile() as inittab_tmp:
+                            inittab_tmp.write(inittab_xen)
+                            inittab_tmp.flush()
+                            outs, errs = run(
+                                ["sudo", "cp", inittab_tmp.name, inittab_path],
+                                timeout=5,
+                            )
+            except OSError as e:
+                errs = str(e)
             if errs:
                 red(
                     "Something went wrong while setting up /etc/inittab for Xen in rootfs.\n"
@@ -382,7 +415,7 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         num_domus = 0  # NUM_DOMUS element in the configuration, also used for iterate over DomUs
         num_dom0less = 0  # used to iterate over Dom0less
-        global TEMPLATE_CONFIG
+        config_parts = [TEMPLATE_CONFIG]  # xen.cfg lines, joined once all VMs are processed
         default_ramdisk = "initrd.cpio"
         default_rootfs = (
             "rootfs.cpio.gz"  # note rootfs could be provided in cpio.gz or tar.gz
@@ -391,29 +424,23 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
         # create auxiliary directory for compiling all artifacts for the hypervisor
         auxdir = "/tmp/hypervisor"
-        run("mkdir " + auxdir + " 2> /dev/null", shell=True, timeout=1)
+        os.makedirs(auxdir, exist_ok=True)
 
         firmware_dir = get_firmware_dir()  # directory where firmware is
+        artifacts = {}  # destination -> source artifacts to link into auxdir
 
-        # save last image, delete rest
+        # kernel artifacts, shared across VMs of the same flavor
+        image_src = firmware_dir + "/kernel/Image"
+        image_dst = auxdir + "/Image"
+        image_rt_src = firmware_dir + "/kernel/Image_PREEMPT_RT"
+        image_rt_dst = auxdir + "/Image_PREEMPT_RT"
+
+        # save last image, delete rest (os.replace overwrites sd_card.img.old)
         if exists(firmware_dir + "/sd_card.img"):
             if exists(firmware_dir + "/sd_card.img.old"):
-                run(
-                    "sudo rm " + firmware_dir + "/sd_card.img.old",
-                    shell=True,
-                    timeout=1,
-                )
                 yellow("- Detected previous sd_card.img.old raw image, deleting.")
 
-            run(
-                "sudo mv "
-                + firmware_dir
-                + "/sd_card.img "
-                + firmware_dir
-                + "/sd_card.img.old",
-                shell=True,
-                timeout=1,
-            )
+            os.replace(firmware_dir + "/sd_card.img", firmware_dir + "/sd_card.img.old")
             yellow(
                 "- Detected previous sd_card.img raw image, moving to sd_card.img.old."
             )
@@ -428,29 +455,17 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
 
             # replace Image in boot partition and assign silly ramdisk (not used)
             if context.args.dom0_arg == "vanilla":
-                # copy to auxdir
-                run(
-                    "cp " + firmware_dir + "/kernel/Image " + auxdir + "/Image",
-                    shell=True,
-                    timeout=1,
-                )
-                TEMPLATE_CONFIG += "DOM0_KERNEL=Image\n"
+                # link into auxdir
+                artifacts[image_dst] = image_src
+                config_parts.append("DOM0_KERNEL=Image\n")
 
             elif context.args.dom0_arg == "preempt_rt":
                 # # directly to boot partition
                 # replace_kernel("Image_PREEMPT_RT")
 
-                # copy to auxdir
-                run(
-                    "cp "
-                    + firmware_dir
-                    + "/kernel/Image_PREEMPT_RT "
-                    + auxdir
-                    + "/Image_PREEMPT_RT",
-                    shell=True,
-                    timeout=1,
-                )
-                TEMPLATE_CONFIG += "DOM0_KERNEL=Image_PREEMPT_RT\n"
+                # link into auxdir
+                artifacts[image_rt_dst] = image_rt_src
+                config_parts.append("DOM0_KERNEL=Image_PREEMPT_RT\n")
             else:
                 red("Unrecognized dom0 arg.")
                 sys.exit(1)
@@ -458,12 +473,8 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
             if context.args.dom0_ramdisk:
                 # Dom's ramdisk
                 if os.path.exists(firmware_dir + "/" + context.args.dom0_ramdisk):
-                    run(
-                        "cp " + firmware_dir + "/" + context.args.dom0_ramdisk + " " + auxdir + "/" + context.args.dom0_ramdisk,
-                        shell=True,
-                        timeout=1,
-                    )
-                    TEMPLATE_CONFIG += "DOM0_RAMDISK="+ context.args.dom0_ramdisk + "\n"
+                    artifacts[auxdir + "/" + context.args.dom0_ramdisk] = firmware_dir + "/" + context.args.dom0_ramdisk
+                    config_parts.append("DOM0_RAMDISK="+ context.args.dom0_ramdisk + "\n")
                     green("- Dom0 ramdisk: " + context.args.dom0_ramdisk)
                 else:
                     red(context.args.dom0_ramdisk + " not found")
@@ -477,11 +488,7 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                     )
                     rootfs = default_rootfs
                     assert exists(firmware_dir + "/" + rootfs)
-                    run(
-                        "cp " + firmware_dir + "/" + rootfs + " " + auxdir + "/" + rootfs,
-                        shell=True,
-                        timeout=1,
-                    )
+                    artifacts[auxdir + "/" + rootfs] = firmware_dir + "/" + rootfs
                 else:
                     rootfs = context.args.rootfs_args[num_domus]
                     num_domus += 1  # jump over first rootfs arg
@@ -490,11 +497,11 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                     # this way, list will be consistent
                     # when interating over DomUs
 
-                TEMPLATE_CONFIG += "DOM0_ROOTFS=" + str(rootfs) + "\n"
+                config_parts.append("DOM0_ROOTFS=" + str(rootfs) + "\n")
                 if self.get_board() == "kv260":
                     # KV260 requires special arguments to handle the juggling of device tree overlays, as opposed to the ramdisk
                     # shipped in the OOB experience
-                    TEMPLATE_CONFIG += 'DOM0_CMD="console=hvc0 earlycon=xen earlyprintk=xen clk_ignore_unused root=/dev/mmcblk0p2"\n'
+                    config_parts.append('DOM0_CMD="console=hvc0 earlycon=xen earlyprintk=xen clk_ignore_unused root=/dev/mmcblk0p2"\n')
 
             #####################
             # process DomUs
@@ -507,36 +514,25 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                         num_domus >= len(context.args.rootfs_args)
                     ):
                         rootfs = default_rootfs
+                        artifacts[auxdir + "/" + rootfs] = firmware_dir + "/" + rootfs
                     else:
                         rootfs = context.args.rootfs_args[num_domus]
 
                     if domu == "vanilla":
                         # add_kernel("Image")  # directly to boot partition
 
-                        # copy to auxdir
-                        run(
-                            "cp " + firmware_dir + "/kernel/Image " + auxdir + "/Image",
-                            shell=True,
-                            timeout=1,
-                        )
-                        TEMPLATE_CONFIG += (
+                        # link into auxdir
+                        artifacts[image_dst] = image_src
+                        config_parts.append(
                             "DOMU_KERNEL[" + str(num_domus) + ']="Image"\n'
                         )
                     elif domu == "preempt_rt":
                         # add_kernel("Image_PREEMPT_RT")  # directly to boot partition
 
-                        # copy to auxdir
-                        run(
-                            "cp "
-                            + firmware_dir
-                            + "/kernel/Image_PREEMPT_RT "
-                            + auxdir
-                            + "/Image_PREEMPT_RT",
-                            shell=True,
-                            timeout=1,
-                        )
+                        # link into auxdir
+                        artifacts[image_rt_dst] = image_rt_src
 
-                        TEMPLATE_CONFIG += (
+                        config_parts.append(
                             "DOMU_KERNEL[" + str(num_domus) + ']="Image_PREEMPT_RT"\n'
                         )
                     else:
@@ -544,10 +540,10 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                         sys.exit(1)
 
                     # Add rootfs
-                    TEMPLATE_CONFIG += (
+                    config_parts.append(
                         "DOMU_ROOTFS[" + str(num_domus) + ']="' + str(rootfs) + '"\n'
                     )
-                    TEMPLATE_CONFIG += "DOMU_NOBOOT[" + str(num_domus) + "]=y\n"
+                    config_parts.append("DOMU_NOBOOT[" + str(num_domus) + "]=y\n")
                     num_domus += 1
 
             #####################
@@ -560,32 +556,21 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                         num_dom0less >= len(context.args.ramdisk_args)
                     ):
                         ramdisk = default_ramdisk
+                        artifacts[auxdir + "/" + ramdisk] = firmware_dir + "/" + ramdisk
                     else:
                         ramdisk = context.args.ramdisk_args[num_dom0less]
 
                     if dom0less == "vanilla":
-                        run(
-                            "cp " + firmware_dir + "/kernel/Image " + auxdir + "/Image",
-                            shell=True,
-                            timeout=1,
-                        )
-                        TEMPLATE_CONFIG += (
+                        artifacts[image_dst] = image_src
+                        config_parts.append(
                             "DOMU_KERNEL["
                             + str(num_dom0less + num_domus)
                             + ']="Image"\n'
                         )
                     elif dom0less == "preempt_rt":
                         # add_kernel("Image_PREEMPT_RT")
-                        run(
-                            "cp "
-                            + firmware_dir
-                            + "/kernel/Image_PREEMPT_RT "
-                            + auxdir
-                            + "/Image_PREEMPT_RT",
-                            shell=True,
-                            timeout=1,
-                        )
-                        TEMPLATE_CONFIG += (
+                        artifacts[image_rt_dst] = image_rt_src
+                        config_parts.append(
                             "DOMU_KERNEL["
                             + str(num_dom0less + num_domus)
                             + ']="Image_PREEMPT_RT"\n'
@@ -594,7 +579,7 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                         red("Unrecognized dom0less arg.")
                         sys.exit(1)
 
-                    TEMPLATE_CONFIG += (
+                    config_parts.append(
                         "DOMU_RAMDISK["
                         + str(num_dom0less + num_domus)
                         + ']="'
@@ -610,49 +595,25 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
             # configuration and images
             #####################
             # Add NUM_DOMUS at the end
-            TEMPLATE_CONFIG += "NUM_DOMUS=" + str(num_domus) + "\n"
-
-            # copy the artifacts to auxiliary directory
-            run("cp " + firmware_dir + "/xen " + auxdir + "/xen", shell=True, timeout=1)
-            run(
-                "cp "
-                + firmware_dir
-                + "/device_tree/system.dtb.xen "
-                + auxdir
-                + "/system.dtb",
-                shell=True,
-                timeout=1,
-            )
+            config_parts.append("NUM_DOMUS=" + str(num_domus) + "\n")
+
+            # link the artifacts into auxiliary directory
+            artifacts[auxdir + "/xen"] = firmware_dir + "/xen"
+            artifacts[auxdir + "/system.dtb"] = firmware_dir + "/device_tree/system.dtb.xen"
 
             if self.get_board() == "kv260":
-                TEMPLATE_CONFIG += ('XEN_CMD="console=dtuart dtuart=serial0 dom0_mem=2G dom0_max_vcpus=1 ' + 
-                                        'bootscrub=0 vwfi=native sched=null"\n')
+                config_parts.append('XEN_CMD="console=dtuart dtuart=serial0 dom0_mem=2G dom0_max_vcpus=1 ' +
+                                    'bootscrub=0 vwfi=native sched=null"\n')
 
                 # # NOTE: do it instead through device tree overlays
                 # run("cp " + firmware_dir + "/ramdisk.cpio.gz.u-boot " + auxdir + "/ramdisk.cpio.gz.u-boot", shell=True, timeout=1)                
-                TEMPLATE_CONFIG += ('DT_OVERLAY[0]="zynqmp-sck-kv-g-qemu.dtbo"\n')
-                TEMPLATE_CONFIG += ('DT_OVERLAY[1]="mmc-enable.dtbo"\n')
-                TEMPLATE_CONFIG += ('NUM_DT_OVERLAY=2\n')
-
-                # copy files
-                run(
-                    "cp "
-                    + firmware_dir
-                    + "/device_tree/mmc-enable.dtbo "
-                    + auxdir
-                    + "/mmc-enable.dtbo",
-                    shell=True,
-                    timeout=1,
-                )
-                run(
-                    "cp "
-                    + firmware_dir
-                    + "/device_tree/zynqmp-sck-kv-g-qemu.dtbo "
-                    + auxdir
-                    + "/zynqmp-sck-kv-g-qemu.dtbo",
-                    shell=True,
-                    timeout=1,
-                )
+                config_parts.append('DT_OVERLAY[0]="zynqmp-sck-kv-g-qemu.dtbo"\n')
+                config_parts.append('DT_OVERLAY[1]="mmc-enable.dtbo"\n')
+                config_parts.append('NUM_DT_OVERLAY=2\n')
+
+                # link files
+                artifacts[auxdir + "/mmc-enable.dtbo"] = firmware_dir + "/device_tree/mmc-enable.dtbo"
+                artifacts[auxdir + "/zynqmp-sck-kv-g-qemu.dtbo"] = firmware_dir + "/device_tree/zynqmp-sck-kv-g-qemu.dtbo"
 
 
                 # NOTE: BOOT.BIN in KV260 is handled differently
@@ -676,99 +637,40 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                         red("BOOT.BIN file " + bootbin_symlink_path + " not found.")
                         sys.exit(1)
                     green("- Found device BOOT.BIN file: " + str(bootbin_symlink_path))
-                    run(
-                        "cp " + str(bootbin_symlink_path) + " " + auxdir + "/BOOT.BIN",
-                        shell=True,
-                        timeout=1,
-                    )
+                    artifacts[auxdir + "/BOOT.BIN"] = str(bootbin_symlink_path)
                 else:
                     green("- Using default BOOT.BIN.xen file.")
-                    run(
-                        "cp "
-                        + firmware_dir
-                        + "/bootbin/BOOT.BIN.xen "
-                        + auxdir
-                        + "/BOOT.BIN",
-                        shell=True,
-                        timeout=1,
-                    )
+                    artifacts[auxdir + "/BOOT.BIN"] = firmware_dir + "/bootbin/BOOT.BIN.xen"
 
                 # Add BOOT.BIN to template
-                TEMPLATE_CONFIG += ('BOOTBIN=BOOT.BIN\n')
+                config_parts.append('BOOTBIN=BOOT.BIN\n')
 
+            config_text = "".join(config_parts)
             if context.args.debug:
                 gray("Debugging config file:")
-                gray(TEMPLATE_CONFIG)
-
-
-            # initrd.cpio
-            # copy (at least) default ramdisk initrd.cpio and default rootfs rootfs.cpio.gz
-            run(
-                "cp "
-                + firmware_dir
-                + "/"
-                + default_ramdisk
-                + " "
-                + auxdir
-                + "/"
-                + default_ramdisk,
-                shell=True,
-                timeout=1,
-            )
-            run(
-                "cp "
-                + firmware_dir
-                + "/"
-                + default_rootfs
-                + " "
-                + auxdir
-                + "/"
-                + default_rootfs,
-                shell=True,
-                timeout=1,
-            )
+                gray(config_text)
 
             # add other ramdisks, if neccessary:
             if context.args.ramdisk_args:
                 for ramdisk in context.args.ramdisk_args:
-                    assert exists(firmware_dir + "/" + ramdisk)
-                    run(
-                        "cp "
-                        + firmware_dir
-                        + "/"
-                        + ramdisk
-                        + " "
-                        + auxdir
-                        + "/"
-                        + ramdisk,
-                        shell=True,
-                        timeout=1,
-                    )
-                    green("- Copied to temporary directory ramdisk: " + ramdisk)
+                    ramdisk_src = firmware_dir + "/" + ramdisk
+                    assert exists(ramdisk_src)
+                    artifacts[auxdir + "/" + ramdisk] = ramdisk_src
 
             # add other rootfs, if neccessary:
             if context.args.rootfs_args:
                 for rootfs in context.args.rootfs_args:
-                    assert exists(firmware_dir + "/" + rootfs)
-                    run(
-                        "cp "
-                        + firmware_dir
-                        + "/"
-                        + rootfs
-                        + " "
-                        + auxdir
-                        + "/"
-                        + rootfs,
-                        shell=True,
-                        timeout=1,
-                    )
-                    green("- Copied to temporary directory rootfs: " + rootfs)
+                    rootfs_src = firmware_dir + "/" + rootfs
+                    assert exists(rootfs_src)
+                    artifacts[auxdir + "/" + rootfs] = rootfs_src
+
+            # symlink all artifacts into the temporary directory at once, imagebuilder
+            # follows them, so there's no need to copy hundreds of MB around
+            _link_artifacts(artifacts)
+            green("- Linked artifacts into temporary directory: " + auxdir)
 
             # produce config
-            config = open(auxdir + "/xen.cfg", "w")
-            config.truncate(0)  # delete previous content
-            config.write(TEMPLATE_CONFIG)
-            config.close()
+            _write_config(auxdir + "/xen.cfg", config_text)
 
             # generate boot script
             yellow("- Generating boot script")
@@ -777,27 +679,25 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                 imagebuilder_dir + "/scripts/uboot-script-gen"
             )
             if self.get_board() == "kv260":
-                cmd = (
-                    "cd "
-                    + auxdir
-                    + " && bash "
-                    + imagebuilder_path_configscript
-                    + ' -c xen.cfg -d . -t "load mmc 1:1"'
-                    # + ' -c xen.cfg -d . -t sd'
-                )
+                boot_target = "load mmc 1:1"
+                # boot_target = "sd"
             else:  # assume zcu102
-                cmd = (
-                    "cd "
-                    + auxdir
-                    + " && bash "
-                    + imagebuilder_path_configscript
-                    + " -c xen.cfg -d . -t sd"
-                )
+                boot_target = "sd"
+            cmd = [
+                "bash",
+                imagebuilder_path_configscript,
+                "-c",
+                "xen.cfg",
+                "-d",
+                ".",
+                "-t",
+                boot_target,
+            ]
 
             if context.args.debug:
-                gray(cmd)
+                gray(" ".join(cmd))
 
-            outs, errs = run(cmd, shell=True, timeout=5)
+            outs, errs = run(cmd, timeout=5, cwd=auxdir)
             if errs:
                 red(
                     "Something went wrong while generating config file.\n"
@@ -811,32 +711,25 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
             yellow(
                 "- Creating new sd_card.img, previous one will be moved to sd_card.img.old. This will take a few seconds, hold on..."
             )
-            whoami, errs = run("whoami", shell=True, timeout=1)
-            if errs:
-                red(
-                    "Something went wrong while fetching username.\n"
-                    + "Review the output: "
-                    + errs
-                )
-                sys.exit(1)
+            whoami = pwd.getpwuid(os.getuid()).pw_name
 
-            # build image, add 500 MB of slack on each rootfs-based partition
+            # build image, add 500 MB of slack on each rootfs-based partition, and
+            # hand the newly created image over to the user within the same sudo call
             imagebuilder_path_diskimage = imagebuilder_dir + "/scripts/disk_image"
-            cmd = (
-                "cd "
-                + auxdir
-                + " && sudo bash "
-                + imagebuilder_path_diskimage
-                + " -c xen.cfg -d . -t sd -w "
-                + auxdir
-                + " -o "
-                + firmware_dir
-                + "/sd_card.img "
-                + "-s 500"
-            )
+            cmd = [
+                "sudo",
+                "bash",
+                "-c",
+                'bash "$1" -c xen.cfg -d . -t sd -w "$2" -o "$3" -s 500 && chown "$4" "$3"',
+                "disk_image",  # $0
+                imagebuilder_path_diskimage,
+                auxdir,
+                firmware_dir + "/sd_card.img",
+                whoami + ":" + whoami,
+            ]
             if context.args.debug:
-                gray(cmd)
-            outs, errs = run(cmd, shell=True, timeout=300)
+                gray(" ".join(cmd))
+            outs, errs = run(cmd, timeout=300, cwd=auxdir)
             if errs:
                 red(
                     "Something went wrong while creating sd card image.\n"
@@ -846,25 +739,6 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                 sys.exit(1)
             green("- Image successfully created")
 
-            # permissions of the newly created image
-            cmd = (
-                "sudo chown "
-                + whoami
-                + ":"
-                + whoami
-                + " "
-                + firmware_dir
-                + "/sd_card.img"
-            )
-            outs, errs = run(cmd, shell=True)
-            if errs:
-                red(
-                    "Something went wrong while creating sd card image.\n"
-                    + "Review the output: "
-                    + errs
-                )
-                sys.exit(1)
-
             # ## use existing SD card image
             # # mount sd_card image
             # rawimage_path = get_rawimage_path("sd_card.img")
@@ -895,14 +769,18 @@ class HypervisorSubverb(AccelerationSubverbExtensionPoint):
                 copy_libstdcppfs(partition=2)  # FIXME: copy missing libstdc++fs library
 
             # apply fixes also to every domU
+            # NOTE: one partition at a time, mount_rawimage() sets up loop devices
+            #       from the partition offset to the end of the image, so two
+            #       partitions mounted at once overlap and the second mount fails
             if context.args.domU_args:
                 for i in range(len(context.args.domU_args)):
                     self.xen_fixes(partition=i + 2 + 1)
                     copy_libstdcppfs(partition=i + 2 + 1)  # FIXME: copy missing libstdc++fs library
 
-            # cleanup auxdir
+            # cleanup auxdir, disk_image runs as root and leaves root-owned
+            # files in its work dir (auxdir), so this one still needs sudo
             if not context.args.debug:
-                run("sudo rm -r " + auxdir, shell=True, timeout=1)
+                run(["sudo", "rm", "-r", auxdir], timeout=1)
 
             # copy ROS workspace to image
             if context.args.install_dir: